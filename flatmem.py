@@ -1,4 +1,7 @@
+from collections import OrderedDict, deque
 from enum import Enum
+import bisect
+import heapq
 import random
 import types
 
@@ -37,15 +40,11 @@ class ReplPolicy(Enum):
     Sample = 5 # Using LRU for /0 set, LFU for /1 set, LRFU for /2 set. Output their hitrate
 
 
-addr_bit = 48
-addr_page_low = 12
-addr_page_bit = addr_bit - addr_page_low
-addr_offset_low = 0
-addr_offset_bit = 12
-addr_region_low = 12
-addr_region_bit = 4
-addr_set_low = addr_region_low + addr_region_bit
-addr_set_bit = addr_bit - addr_set_low
+class TimingModel(Enum):
+    Serial = 0  # fastmem and slowmem are synchronized after every request
+    Banked = 1  # independent channels/banks per memory, migrations overlap with demand accesses
+
+
 INF = 1000000000
 c_trans_cache_capacity_per_set = 4
 
@@ -53,19 +52,35 @@ c_trans_cache_capacity_per_set = 4
 class Memory(TimingObj):
     access_cnt = 0
 
-    def __init__(self, capacity, read_lat, write_lat, name="memory"):
+    def __init__(self, capacity, read_lat, write_lat, name="memory", channels=1, banks=1, queue_depth=0, page_shift=12):
         self.capacity = capacity
         self.read_lat = read_lat
         self.write_lat = write_lat
         self.name = name
         self.used_cycle = 0
-
-    def request(self, event):
+        # only used by TimingModel.Banked
+        if channels < 1 or banks < 1:
+            print("[Error] %s needs at least 1 channel and 1 bank, got channels:%d banks:%d" %
+                  (name, channels, banks))
+            exit(-1)
+        self.channels = channels
+        self.banks = banks  # banks per channel
+        self.queue_depth = queue_depth  # max outstanding requests per channel, 0 = unbounded
+        self.page_shift = page_shift  # interleaving granularity
+        self.bank_busy = [[] for _ in range(channels * banks)]  # sorted (start cycle, end cycle) per bank
+        self.channel_queue = [[] for _ in range(channels)]  # heap of (completion cycle, arrival cycle)
+        self.queue_cycle = 0
+        self.request_cnt = 0
+
+    def check_capacity(self, event):
         # print("addr:%x capacity:%x" % (event.m_addr, self.capacity))
         if event.m_addr > self.capacity:
             print("[Error] Out of %s %x>%x!" %
                   (self.name, event.m_addr, self.capacity))
             exit(-1)  # out of memory exception
+
+    def request(self, event):
+        self.check_capacity(event)
         if event.is_write:
             self.avail_cycle = max(
                 self.avail_cycle, event.current_cycle) + self.write_lat
@@ -79,51 +94,166 @@ class Memory(TimingObj):
             self.access_cnt += 1
             # print("[info] Access %s  %x" % (self.name, event.m_addr))
 
+    def retire(self, cycle):
+        # no request arrives before cycle any more, forget the ones completed by then
+        for queue in self.channel_queue:
+            while len(queue) > 0 and queue[0][0] <= cycle:
+                heapq.heappop(queue)
+        for busy in self.bank_busy:
+            done = 0
+            while done < len(busy) and busy[done][1] <= cycle:
+                done += 1
+            del busy[:done]
+
+    def bank_start(self, bank, issue_cycle, cycle):
+        # first idle gap of the bank at or after issue_cycle that fits the request.
+        # Bookings are kept as intervals because requests are not booked in arrival order:
+        # a migration write booked in the future must not delay an earlier demand access.
+        start_cycle = issue_cycle
+        for (busy_start, busy_end) in self.bank_busy[bank]:
+            if busy_end <= start_cycle:
+                continue
+            if busy_start >= start_cycle + cycle:
+                break
+            start_cycle = busy_end
+        return start_cycle
+
+    def occupy(self, bank, arrive_cycle, cycle):
+        # a request waits for a free slot in its channel queue, then for its bank.
+        # Requests do not arrive in time order (migration writes arrive in the future),
+        # so count the ones outstanding at this request's own arrival.
+        queue = self.channel_queue[bank // self.banks]
+        outstanding = sorted(done for (done, arrive) in queue
+                             if arrive <= arrive_cycle < done)
+        issue_cycle = arrive_cycle
+        if self.queue_depth > 0 and len(outstanding) >= self.queue_depth:
+            # wait until enough outstanding requests complete
+            issue_cycle = outstanding[len(outstanding) - self.queue_depth]
+        start_cycle = self.bank_start(bank, issue_cycle, cycle)
+        done_cycle = start_cycle + cycle
+        bisect.insort(self.bank_busy[bank], (start_cycle, done_cycle))
+        heapq.heappush(queue, (done_cycle, arrive_cycle))
+        self.avail_cycle = max(self.avail_cycle, done_cycle)
+        self.used_cycle += cycle
+        self.queue_cycle += start_cycle - arrive_cycle
+        self.request_cnt += 1
+        return done_cycle
+
+    def bank_request(self, event):
+        self.check_capacity(event)
+        # pages are interleaved across channels first, then across banks
+        m_page = event.m_addr >> self.page_shift
+        channel = m_page % self.channels
+        bank = channel * self.banks + (m_page // self.channels) % self.banks
+        lat = self.write_lat if event.is_write else self.read_lat
+        event.current_cycle = self.occupy(bank, event.current_cycle, lat)
+        if not event.is_migration:
+            self.access_cnt += 1
+
+    def occupy_any(self, arrive_cycle, cycle):
+        # requests without an address (e.g. trans_table lookup) take the bank that is free first
+        bank = min(range(len(self.bank_busy)), key=lambda b: self.bank_start(b, arrive_cycle, cycle))
+        return self.occupy(bank, arrive_cycle, cycle)
+
+    def utilization(self, total_cycle):
+        if total_cycle == 0:
+            return 0.0
+        return 1.0 * self.used_cycle / (total_cycle * self.channels * self.banks)
+
+    def avg_queue_cycle(self):
+        if self.request_cnt == 0:
+            return 0.0
+        return 1.0 * self.queue_cycle / self.request_cnt
+
+
+class AddrGeometry(object):
+    # address layout: | set | region | offset |. A page number is | set | region |.
+    # Shifts and masks are precomputed so several geometries can coexist in one process.
+    def __init__(self, addr_bit, offset_bit, region_bit):
+        if region_bit <= 0 or offset_bit <= 0 or offset_bit + region_bit >= addr_bit:
+            print("[Error] Invalid geometry addr_bit:%d offset_bit:%d region_bit:%d" %
+                  (addr_bit, offset_bit, region_bit))
+            exit(-1)
+        self.addr_bit = addr_bit
+        self.offset_bit = offset_bit
+        self.region_bit = region_bit
+        self.set_bit = addr_bit - offset_bit - region_bit
+        self.set_low = offset_bit + region_bit
+        self.region_num = 1 << region_bit
+        self.offset_mask = (1 << offset_bit) - 1
+        self.region_mask = self.region_num - 1
+        self.page_mask = (1 << (addr_bit - offset_bit)) - 1
+        self.set_mask = (1 << self.set_bit) - 1
+
+    def page(self, address):
+        return (address >> self.offset_bit) & self.page_mask
+
+    def offset(self, address):
+        return address & self.offset_mask
 
-def extract_bit(value, start, len):
-    tmp = value >> start
-    mask = (1 << len) - 1
-    # print("extract value%x start%d len%d res%x" % (value, start, len, tmp & mask))
-    return tmp & mask
+    def region(self, address):
+        return (address >> self.offset_bit) & self.region_mask
 
+    def set_id(self, address):
+        return (address >> self.set_low) & self.set_mask
 
-def make_address(addr_set, addr_region, addr_offset):
-    address = addr_set
-    address = address << addr_region_bit | addr_region
-    address = address << addr_offset_bit | addr_offset
-    return address
+    def page_region(self, page):
+        return page & self.region_mask
+
+    def make_page(self, addr_set, addr_region):
+        return (addr_set << self.region_bit) | addr_region
+
+    def make_address(self, addr_set, addr_region, addr_offset):
+        return (self.make_page(addr_set, addr_region) << self.offset_bit) | addr_offset
 
 
 class FlatMemory(TimingObj):
-    trans_table = {}  # in fastmem. p_page -> m_page
     uncached_fast_trans_num = 0
     cached_fast_trans_num = 0
 
     def trans_table_remove(self, page):
         if page in self.trans_table:
-            del self.trans_table[page]
+            self.trans_table_set(page, page)
 
     def __init__(self, flatconfig):
+        self.geometry = AddrGeometry(
+            flatconfig["addr_bit"], flatconfig["offset_bit"], flatconfig["region_bit"])
+        if flatconfig["fast_block"] > self.geometry.region_num:
+            print("[Error] fast_block %d > %d regions per set" %
+                  (flatconfig["fast_block"], self.geometry.region_num))
+            exit(-1)
+        self.trans_table = {}  # in fastmem. p_page -> m_page
+        self.trans_table_inv = {}  # m_page -> p_page, mirrors trans_table
+        self.moved_pregions = {}  # set_id -> {p_region: in_fast} for pages not in their home memory
+        self.timing_model = flatconfig["timing_model"]
+        # by default the capacities follow the geometry: the last set's last fast/slow region
+        fast_cap = flatconfig["fast_cap"]
+        if fast_cap == 0:
+            fast_cap = self.geometry.make_address(
+                flatconfig["set_num"] - 1, flatconfig["fast_block"] - 1, self.geometry.offset_mask)
+        slow_cap = flatconfig["slow_cap"]
+        if slow_cap == 0:
+            slow_cap = self.geometry.make_address(
+                flatconfig["set_num"] - 1, self.geometry.region_mask, self.geometry.offset_mask)
         self.fastmem = Memory(
-            flatconfig["fast_cap"], flatconfig["fast_read_lat"], flatconfig["fast_write_lat"], "fastmem")
+            fast_cap, flatconfig["fast_read_lat"], flatconfig["fast_write_lat"], "fastmem",
+            flatconfig["fast_channels"], flatconfig["fast_banks"], flatconfig["mem_queue_depth"], self.geometry.offset_bit)
         self.slowmem = Memory(
-            flatconfig["slow_cap"], flatconfig["slow_read_lat"], flatconfig["slow_write_lat"], "slowmem")
+            slow_cap, flatconfig["slow_read_lat"], flatconfig["slow_write_lat"], "slowmem",
+            flatconfig["slow_channels"], flatconfig["slow_banks"], flatconfig["mem_queue_depth"], self.geometry.offset_bit)
         self.trans_table_read_lat = flatconfig["fast_read_lat"]
         self.fast_block = flatconfig["fast_block"]
         self.epoch_trans_hit = 0
         self.epoch_trans_access = 0
 
-    def mpage_in_fastmem(self, maddress):
-        region = extract_bit(maddress, addr_region_low -
-                             addr_page_low, addr_region_bit)
-        return region < self.fast_block
+    def mpage_in_fastmem(self, mpage):
+        return self.geometry.page_region(mpage) < self.fast_block
 
     def maddr_in_fastmem(self, maddress):
-        region = extract_bit(maddress, addr_region_low, addr_region_bit)
-        return region < self.fast_block
+        return self.geometry.region(maddress) < self.fast_block
 
     def paddr_in_fastmem(self, paddress):
-        p_page = extract_bit(paddress, addr_page_low, addr_page_bit)
+        p_page = self.geometry.page(paddress)
         m_page = self.trans_table.get(p_page, p_page)  # default=p_page
         return self.mpage_in_fastmem(m_page)
 
@@ -132,28 +262,48 @@ class FlatMemory(TimingObj):
         return self.mpage_in_fastmem(m_page)
 
     def translate_address(self, paddress):
-        p_page = extract_bit(paddress, addr_page_low, addr_page_bit)
-        p_offset = extract_bit(paddress, addr_offset_low, addr_offset_bit)
+        p_page = self.geometry.page(paddress)
+        p_offset = self.geometry.offset(paddress)
         m_page = self.trans_table.get(p_page, p_page)  # default=p_page
-        m_address = (m_page << addr_page_low) | p_offset
+        m_address = (m_page << self.geometry.offset_bit) | p_offset
         # print("translate paddr%x maddr%x" % (paddress, m_address))
         return m_address
 
+    def fast_pregions(self, set_id):
+        # p_regions of a set currently in fastmem, without translating every region
+        fast_pregions = set(range(self.fast_block))
+        for (p_region, in_fast) in self.moved_pregions.get(set_id, {}).items():
+            if in_fast:
+                fast_pregions.add(p_region)
+            else:
+                fast_pregions.discard(p_region)
+        return fast_pregions
+
     def translate_page_inv(self, ppage):
-        if not ppage in self.trans_table:
-            # ppage is not swapped. The inverted page is itself
-            return ppage
-        for (ppage_i, mpage_i) in self.trans_table.items():
-            if mpage_i == ppage:
-                return ppage_i
+        # if ppage is not swapped, the inverted page is itself
+        return self.trans_table_inv.get(ppage, ppage)
 
     def sync_cycle(self):
+        if self.timing_model == TimingModel.Banked:
+            return  # avail_cycle follows the current demand request, memories run independently
         self.avail_cycle = max(self.fastmem.avail_cycle,
                                self.slowmem.avail_cycle)
-        # we take a serialization timing model so far
+        # we take a serialization timing model
         self.fastmem.avail_cycle = self.slowmem.avail_cycle = self.avail_cycle
 
+    def retire(self, cycle):
+        self.fastmem.retire(cycle)
+        self.slowmem.retire(cycle)
+
+    def drain_cycle(self):
+        # cycle when all demand accesses and background migrations are done
+        return max(self.avail_cycle, self.fastmem.avail_cycle, self.slowmem.avail_cycle)
+
     def advance_cycle(self, is_fastmem, cycle):
+        if self.timing_model == TimingModel.Banked:
+            mem = self.fastmem if is_fastmem else self.slowmem
+            self.avail_cycle = mem.occupy_any(self.avail_cycle, cycle)
+            return
         if is_fastmem:
             self.fastmem.avail_cycle = max(
                 self.fastmem.avail_cycle, self.avail_cycle) + cycle
@@ -166,20 +316,37 @@ class FlatMemory(TimingObj):
                                self.slowmem.avail_cycle)
 
     def trans_table_set(self, new_ppage, new_mpage):
+        old_mpage = self.trans_table.get(new_ppage, new_ppage)
+        if self.trans_table_inv.get(old_mpage) == new_ppage:
+            del self.trans_table_inv[old_mpage]
+        set_id = new_ppage >> self.geometry.region_bit  # pages only move within their set
+        p_region = self.geometry.page_region(new_ppage)
+        in_fast = self.mpage_in_fastmem(new_mpage)
+        moved = self.moved_pregions.setdefault(set_id, {})
+        if in_fast != (p_region < self.fast_block):
+            moved[p_region] = in_fast
+        elif p_region in moved:
+            del moved[p_region]
+            if len(moved) == 0:
+                del self.moved_pregions[set_id]
         if new_ppage == new_mpage:
             if new_ppage in self.trans_table:
                 del self.trans_table[new_ppage]
             return
         self.trans_table[new_ppage] = new_mpage
+        self.trans_table_inv[new_mpage] = new_ppage
 
     def request(self, event):
         event.m_addr = self.translate_address(event.p_addr)
         in_fast = self.maddr_in_fastmem(event.m_addr)
         # print("granted access %x -> %x in_fast %x" % (event.p_addr, event.m_addr, in_fast))
-        if in_fast:
-            self.fastmem.request(event)
+        mem = self.fastmem if in_fast else self.slowmem
+        if self.timing_model == TimingModel.Banked:
+            mem.bank_request(event)
+            if not event.is_migration:
+                self.avail_cycle = max(self.avail_cycle, event.current_cycle)
         else:
-            self.slowmem.request(event)
+            mem.request(event)
         self.sync_cycle()
         return in_fast
 
@@ -222,10 +389,11 @@ class MetaCache(TimingObj):
     def __init__(self, set_id, flatmem, repl_policy):
         self.set_id = set_id
         self.flatmem = flatmem
+        self.geometry = flatmem.geometry
         self.timestamp = 0  # for ReplPolicy.LRU or ReplPolicy.LRULIP
         self.set_repl_policy(repl_policy)
-    # List of pages. we do not actually duplicate transtable. Use a bool array to cancel latency for cached mapping.
-    cached_trans_table = []
+        # List of pages. we do not actually duplicate transtable. Use a bool array to cancel latency for cached mapping.
+        self.cached_trans_table = []
 
     def trans_cache_remove(self, page):
         if self.cached_trans_table.count(page):
@@ -236,7 +404,7 @@ class MetaCache(TimingObj):
         if self.repl_policy == ReplPolicy.LRU or self.repl_policy == ReplPolicy.LRULIP or self.repl_policy == ReplPolicy.LRFU:
             self.timestamp += 1
         new_entry = False
-        p_region = extract_bit(event.p_addr, addr_region_low, addr_region_bit)
+        p_region = self.geometry.region(event.p_addr)
         # create new entry
         if not p_region in self.entries:
             if self.repl_policy == ReplPolicy.LRU or self.repl_policy == ReplPolicy.LRULIP:
@@ -269,7 +437,7 @@ class MetaCache(TimingObj):
         # print("debug region:%x hotness:%d" % (p_region, self.entries[p_region].hotness))
 
     def access_trans_cache(self, p_addr):
-        p_page = extract_bit(p_addr, addr_page_low, addr_page_bit)
+        p_page = self.geometry.page(p_addr)
         # print(self.cached_trans_table)
         if not p_page in self.cached_trans_table:
             self.flatmem.uncached_fast_trans_num += 1
@@ -293,9 +461,9 @@ class MetaCache(TimingObj):
     def find_victim(self, event):
         min_hotness = INF
         min_hotness_region = -1
+        fast_pregions = self.flatmem.fast_pregions(self.set_id)
         for region_id, item in self.entries.items():
-            p_addr = make_address(self.set_id, region_id, 0)
-            if self.flatmem.paddr_in_fastmem(p_addr):
+            if region_id in fast_pregions:
                 hotness = item.hotness
                 if self.repl_policy == ReplPolicy.LRFU:
                     # get hotness on-demand
@@ -311,6 +479,28 @@ class MetaCache(TimingObj):
             return min_hotness_region
         return -1
 
+    def is_empty(self):
+        # nothing worth keeping once evicted, a fresh MetaCache behaves the same
+        return len(self.entries) == 0 and len(self.cached_trans_table) == 0
+
+    def compact(self):
+        # compact form of an evicted set: entries are flattened to (region, hotness, ...)
+        entries = tuple(v for (region_id, item) in self.entries.items()
+                        for v in (region_id, item.hotness))
+        lrfu_history = ()
+        if self.repl_policy == ReplPolicy.LRFU:
+            lrfu_history = tuple((region_id, tuple(history))
+                                 for (region_id, history) in self.lrfu_history.items())
+        return (self.timestamp, entries, lrfu_history, tuple(self.cached_trans_table))
+
+    def restore(self, compact):
+        (self.timestamp, entries, lrfu_history, cached_trans_table) = compact
+        for i in range(0, len(entries), 2):
+            self.entries[entries[i]] = CacheEntry(entries[i + 1])
+        for (region_id, history) in lrfu_history:
+            self.lrfu_history[region_id] = list(history)
+        self.cached_trans_table = list(cached_trans_table)
+
     def get_hotness_rank(self):
         # return self.entries
         sorted_list = sorted(self.entries.items(),
@@ -321,31 +511,57 @@ class MetaCache(TimingObj):
 
 
 flat_config1 = {
-    "fast_cap": 0x20f1fff,  # 16KB, 4 blocks * 15 sets
-    "slow_cap": 0x20fffff,  # 128KB, 14 blocks * 15 sets
+    "set_num": 0x210,  # fast_cap/slow_cap cover set_num sets of the geometry
+    "fast_cap": 0,  # highest fast address, 0 = derived from set_num (0x20f1fff)
+    "slow_cap": 0,  # highest slow address, 0 = derived from set_num (0x20fffff)
     "fast_read_lat": 1,
     "fast_write_lat": 1,
     "slow_read_lat": 2,
     "slow_write_lat": 2,
-    "fast_block": 2,
+    "fast_block": 2,  # fast regions per set
+    "addr_bit": 48,
+    "offset_bit": 12,  # page size, 21 for 2MB pages
+    "region_bit": 4,  # 1 << region_bit regions per set
     "swap_policy": SwapPolicy.FastSwap,
     "bypass_policy": BypassPolicy.Never,
     "bypass_probability": 0.5,
     "repl_policy": ReplPolicy.LRU,
+    "timing_model": TimingModel.Serial,
+    "fast_channels": 1,
+    "fast_banks": 4,
+    "slow_channels": 1,
+    "slow_banks": 4,
+    "mem_queue_depth": 16,
+    "max_outstanding": 4,  # demand requests in flight in Banked mode
+    "max_metasets": 0,  # resident MetaCaches, colder sets are kept compact. 0 = unbounded
+    "max_cold_metasets": 0,  # compact sets kept, older ones are dropped and their hotness resets. 0 = unbounded
 }
 
 flat_config_dram_nvm = {
-    "fast_cap": 0x1001fff,  # 16KB, 2 blocks * 15 sets
-    "slow_cap": 0x100ffff,  # 128KB, 14 blocks * 15 sets
+    "set_num": 0x101,  # fast_cap/slow_cap cover set_num sets of the geometry
+    "fast_cap": 0,  # highest fast address, 0 = derived from set_num (0x1001fff)
+    "slow_cap": 0,  # highest slow address, 0 = derived from set_num (0x100ffff)
     "fast_read_lat": 1,
     "fast_write_lat": 1,
     "slow_read_lat": 5,
     "slow_write_lat": 10,
-    "fast_block": 2,
+    "fast_block": 2,  # fast regions per set
+    "addr_bit": 48,
+    "offset_bit": 12,  # page size, 21 for 2MB pages
+    "region_bit": 4,  # 1 << region_bit regions per set
     "swap_policy": SwapPolicy.SlowSwap,
     "bypass_policy": BypassPolicy.Probability,
     "bypass_probability": 0.5,
     "repl_policy": ReplPolicy.LRU,
+    "timing_model": TimingModel.Serial,
+    "fast_channels": 1,
+    "fast_banks": 4,
+    "slow_channels": 1,
+    "slow_banks": 4,
+    "mem_queue_depth": 16,
+    "max_outstanding": 4,  # demand requests in flight in Banked mode
+    "max_metasets": 0,  # resident MetaCaches, colder sets are kept compact. 0 = unbounded
+    "max_cold_metasets": 0,  # compact sets kept, older ones are dropped and their hotness resets. 0 = unbounded
 }
 
 
@@ -358,34 +574,30 @@ class SmartSwap(object):
 
     def __init__(self, rank_list, flatmem, set_id):
         self.rank_list = rank_list  # head is the LRU while tail is the MRU
+        self.rank = dict((pregion, i) for (i, pregion) in enumerate(rank_list))
         self.flatmem = flatmem
+        self.geometry = flatmem.geometry
         self.set_id = set_id
         self.fast_region = []
+        fast_pregions = self.flatmem.fast_pregions(set_id)
         for pregion in self.rank_list:
-            ppage = extract_bit(make_address(
-                set_id, pregion, 0), addr_page_low, addr_page_bit)
-            is_fast = self.flatmem.ppage_in_fastmem(ppage)
+            is_fast = pregion in fast_pregions
             if (not is_fast):
                 self.slow_mru_region = pregion
             elif (is_fast):
                 self.fast_region.append(pregion)
 
     def search_region_in_rank(self, page):
-        for i in range(len(self.rank_list)):
-            if self.rank_list[i] == page:
-                return i  # return the rank
-        return -1
+        return self.rank.get(page, -1)
 
     def find_best_restore_choice(self):
         max_util = -1
         best_src = best_dst = -1
         for pregion in self.fast_region:
-            ppage = extract_bit(make_address(
-                self.set_id, pregion, 0), addr_page_low, addr_page_bit)
+            ppage = self.geometry.make_page(self.set_id, pregion)
             ppage_prev = self.flatmem.translate_page_inv(ppage)
             if ppage_prev != ppage:
-                pregion_prev = extract_bit(
-                    ppage_prev, addr_region_low, addr_region_bit)
+                pregion_prev = self.geometry.page_region(ppage_prev)
                 ppage_rank = self.search_region_in_rank(pregion)
                 ppage_prev_rank = self.search_region_in_rank(pregion_prev)
 
@@ -408,17 +620,27 @@ class SmartSwap(object):
 
 
 class FlatController(TimingObj):
-    metasets = {}  # set_id -> MetaCache
     access_cnt = 0
 
     def __init__(self):
-        self.config = flat_config1  # select default config
+        self.config = dict(flat_config1)  # select default config
         self.flatmem = FlatMemory(self.config)
-        self.epoch_slowhit = 0
-        self.epoch_fasthit = 0
-        self.max_set_id = 0 # maximum set
+        self.geometry = self.flatmem.geometry
+        self.metasets = OrderedDict()  # set_id -> MetaCache, head is the LRU set
+        self.cold_metasets = OrderedDict()  # set_id -> MetaCache.compact() of evicted sets, head is the oldest
+        self.metaset_evict_cnt = 0
+        self.metaset_drop_cnt = 0
+        self.metaset_rebuild_cnt = 0
+        self.epoch_slowhit = {}  # set_id -> slow accesses in this epoch
+        self.epoch_fasthit = {}  # set_id -> fast accesses in this epoch
+        self.issue_cycle = 0  # issue cycle of the latest demand request, Banked mode only
+        self.inflight = deque()  # completion cycles of the latest max_outstanding demand requests
 
     def set_config(self, dic):
+        if self.access_cnt > 0:
+            # FlatMemory is rebuilt below, MetaCaches and statistics would still refer to the old one
+            print("[Error] set_config after %d accesses" % self.access_cnt)
+            exit(-1)
         for (k_i, v_i) in dic.items():
             if not k_i in self.config:
                 print("[warning] ignore %s" % k_i)
@@ -429,11 +651,18 @@ class FlatController(TimingObj):
                 self.config["bypass_policy"] = BypassPolicy[v_i]
             elif k_i == "repl_policy":
                 self.config["repl_policy"] = ReplPolicy[v_i]
+            elif k_i == "timing_model":
+                self.config["timing_model"] = TimingModel[v_i]
             elif isinstance(self.config[k_i], int):
-                self.config[k_i] = int(v_i)
+                if v_i.lower().startswith("0x"):
+                    self.config[k_i] = int(v_i, 16)  # hex capacities
+                else:
+                    self.config[k_i] = int(v_i)
             elif isinstance(self.config[k_i], float):
                 self.config[k_i] = float(v_i)
             print("[info] change %s to %s" % (k_i, v_i))
+        self.flatmem = FlatMemory(self.config)  # memory parameters may have changed
+        self.geometry = self.flatmem.geometry
 
         if self.config["swap_policy"] == SwapPolicy.SmartSwap:
             self.smart_swap_repl_cnt = 0
@@ -458,11 +687,64 @@ class FlatController(TimingObj):
             else:
                 return not in_fast  # migrate if access slowmem
 
+    def get_repl_policy(self, set_id):
+        repl_policy = self.config["repl_policy"]
+        if self.config["repl_policy"] == ReplPolicy.Sample:
+            # if in Sample mode, set different policies for different sets. Output their hitrate respectively.
+            if set_id % 3 == 0:
+                repl_policy = ReplPolicy.LRU
+            elif set_id % 3 == 1:
+                repl_policy = ReplPolicy.LFU
+            elif set_id % 3 == 2:
+                repl_policy = ReplPolicy.LRFU
+        return repl_policy
+
+    def get_metaset(self, set_id):
+        if set_id in self.metasets:
+            self.metasets.move_to_end(set_id)
+            return self.metasets[set_id]
+        metaset = MetaCache(set_id, self.flatmem, self.get_repl_policy(set_id))
+        if set_id in self.cold_metasets:
+            metaset.restore(self.cold_metasets.pop(set_id))
+            self.metaset_rebuild_cnt += 1
+        self.metasets[set_id] = metaset
+        # keep at most max_metasets resident, the current set is the MRU and stays
+        while self.config["max_metasets"] > 0 and len(self.metasets) > self.config["max_metasets"]:
+            (cold_set_id, cold_metaset) = self.metasets.popitem(last=False)
+            self.metaset_evict_cnt += 1
+            if not cold_metaset.is_empty():
+                self.cold_metasets[cold_set_id] = cold_metaset.compact()
+        # keep at most max_cold_metasets compact, the oldest evicted sets restart from scratch
+        while self.config["max_cold_metasets"] > 0 and len(self.cold_metasets) > self.config["max_cold_metasets"]:
+            self.cold_metasets.popitem(last=False)
+            self.metaset_drop_cnt += 1
+        return metaset
+
+    def epoch_hit_sum(self, epoch_hit, sample_idx=-1):
+        # sample_idx selects the sets of one policy in ReplPolicy.Sample mode
+        if sample_idx == -1:
+            return sum(epoch_hit.values())
+        return sum(n for (set_id, n) in epoch_hit.items() if set_id % 3 == sample_idx)
+
     def sync_cycle(self):
         self.flatmem.sync_cycle()
         self.avail_cycle = max(self.avail_cycle, self.flatmem.avail_cycle)
 
     def gen_swap_event(self, p_addr1, p_addr2):
+        if self.config["timing_model"] == TimingModel.Banked:
+            # migration runs in the background once the triggering demand request completes:
+            # both pages are read, then both are written back.
+            # Demand accesses only see it through bank and queue contention.
+            read1 = MemEvent(p_addr1, False, self.flatmem.avail_cycle, is_migration=True)
+            read2 = MemEvent(p_addr2, False, self.flatmem.avail_cycle, is_migration=True)
+            self.flatmem.request(read1)
+            self.flatmem.request(read2)
+            read_done_cycle = max(read1.current_cycle, read2.current_cycle)
+            self.flatmem.request(
+                MemEvent(p_addr1, True, read_done_cycle, is_migration=True))
+            self.flatmem.request(
+                MemEvent(p_addr2, True, read_done_cycle, is_migration=True))
+            return
         self.flatmem.request(
             MemEvent(p_addr1, False, self.avail_cycle, is_migration=True))
         self.flatmem.sync_cycle()
@@ -481,17 +763,17 @@ class FlatController(TimingObj):
         infast_2 = self.flatmem.paddr_in_fastmem(p_addr2)
         # p_addr1 is victim page (in fastmem), p_addr2 is challenging page (in slowmem)
         assert(infast_1 ^ infast_2)  # must be one fastblock and one slowblock
-        p_page1 = extract_bit(p_addr1, addr_page_low, addr_page_bit)
-        p_page2 = extract_bit(p_addr2, addr_page_low, addr_page_bit)
+        p_page1 = self.geometry.page(p_addr1)
+        p_page2 = self.geometry.page(p_addr2)
         # p_addr1, p_addr2 must be in the same set
-        set_id = extract_bit(p_addr1, addr_set_low, addr_set_bit)
+        set_id = self.geometry.set_id(p_addr1)
         if swap_policy == SwapPolicy.FastSwap:
             self.gen_swap_event(p_addr1, p_addr2)
             self.fast_swap_swap_cnt += 1
-            m_addr1 = self.metasets[set_id].access_trans_cache(p_addr1) # we may not have addr1 translation info (only checked victim states)
+            m_addr1 = self.get_metaset(set_id).access_trans_cache(p_addr1) # we may not have addr1 translation info (only checked victim states)
             m_addr2 = self.flatmem.translate_address(p_addr2) # we have addr2 translation info (just accessed)
-            m_page1 = extract_bit(m_addr1, addr_page_low, addr_page_bit)
-            m_page2 = extract_bit(m_addr2, addr_page_low, addr_page_bit)
+            m_page1 = self.geometry.page(m_addr1)
+            m_page2 = self.geometry.page(m_addr2)
             # print("[info] swap: p1 %x m1 %x  p2 %x m2 %x" % (p_addr1, m_addr1, p_addr2, m_addr2))
             self.flatmem.trans_table_set(p_page1, m_page2)
             self.flatmem.trans_table_set(p_page2, m_page1)
@@ -501,11 +783,11 @@ class FlatController(TimingObj):
             # exception: when the challenger was originally in fastmem, swap challenger with trans[challenger]
             if self.flatmem.maddr_in_fastmem(p_addr2):
                 p_addr1 = self.flatmem.translate_address(p_addr2)
-                p_page1 = extract_bit(p_addr1, addr_page_low, addr_page_bit)
+                p_page1 = self.geometry.page(p_addr1)
 
-            m_addr1 = self.metasets[set_id].access_trans_cache(
+            m_addr1 = self.get_metaset(set_id).access_trans_cache(
                 p_addr1)  # check whether fastblock is not swapped
-            m_page1 = extract_bit(m_addr1, addr_page_low, addr_page_bit)
+            m_page1 = self.geometry.page(m_addr1)
             # print("first migrate %x %x" % (p_addr1, m_addr1))
             if p_addr1 != m_addr1:
                 # print("migration start", self.flatmem.trans_table)
@@ -527,14 +809,14 @@ class FlatController(TimingObj):
             assert(len(self.flatmem.trans_table) % 2 == 0)
         elif swap_policy == SwapPolicy.SmartSwap:
             # p_addr1, p_addr2 must be in the same set
-            set_id = extract_bit(p_addr1, addr_set_low, addr_set_bit)
+            set_id = self.geometry.set_id(p_addr1)
             iteration_cnt = 0
             swap_history = []  # stop replicate swappings
             while True:
                 if iteration_cnt > 10:  # for debugging
                     print("[warning] iteration more than 10")
                     break
-                hotness_rank_list = self.metasets[set_id].get_hotness_rank()
+                hotness_rank_list = self.get_metaset(set_id).get_hotness_rank()
                 swap_agent = SmartSwap(hotness_rank_list, self.flatmem, set_id)
                 (repl_util, repl_src, repl_dst) = swap_agent.get_repl_util()
                 (restore_util, restore_src,
@@ -550,19 +832,17 @@ class FlatController(TimingObj):
                 else:
                     (swap_region1, swap_region2) = (restore_src, restore_dst)
                     self.smart_swap_restore_cnt += 1
-                swap_paddr1 = make_address(set_id, swap_region1, 0x0)
-                swap_paddr2 = make_address(set_id, swap_region2, 0x0)
-                swap_page1 = extract_bit(
-                    swap_paddr1, addr_page_low, addr_page_bit)
-                swap_page2 = extract_bit(
-                    swap_paddr2, addr_page_low, addr_page_bit)
+                swap_paddr1 = self.geometry.make_address(set_id, swap_region1, 0x0)
+                swap_paddr2 = self.geometry.make_address(set_id, swap_region2, 0x0)
+                swap_page1 = self.geometry.page(swap_paddr1)
+                swap_page2 = self.geometry.page(swap_paddr2)
                 if swap_history.count((swap_paddr1, swap_paddr2)) > 0:
                     break  # replicate swappings, break the loop
 
-                m_addr1 = self.metasets[set_id].access_trans_cache(swap_paddr1)
-                m_addr2 = self.metasets[set_id].access_trans_cache(swap_paddr2)
-                m_page1 = extract_bit(m_addr1, addr_page_low, addr_page_bit)
-                m_page2 = extract_bit(m_addr2, addr_page_low, addr_page_bit)
+                m_addr1 = self.get_metaset(set_id).access_trans_cache(swap_paddr1)
+                m_addr2 = self.get_metaset(set_id).access_trans_cache(swap_paddr2)
+                m_page1 = self.geometry.page(m_addr1)
+                m_page2 = self.geometry.page(m_addr2)
                 # print("migration start", self.flatmem.trans_table)
                 swap_history.append((swap_paddr1, swap_paddr2))
                 self.gen_swap_event(swap_paddr1, swap_paddr2)
@@ -579,34 +859,40 @@ class FlatController(TimingObj):
 
     def post_access(self, event):
         # migration
-        set_id = extract_bit(event.p_addr, addr_set_low, addr_set_bit)
+        set_id = self.geometry.set_id(event.p_addr)
         if self.trig_monitor(event):
-            victim_p_region = self.metasets[set_id].find_victim(event)
+            victim_p_region = self.get_metaset(set_id).find_victim(event)
             if victim_p_region != -1:
                 p_address = event.p_addr
-                victim_p_address = make_address(set_id, victim_p_region, 0)
+                victim_p_address = self.geometry.make_address(set_id, victim_p_region, 0)
                 self.start_migration(
                     victim_p_address, p_address, self.config["swap_policy"])
 
+    def issue_demand(self, event):
+        if self.config["timing_model"] == TimingModel.Banked:
+            # a demand request issues once the request max_outstanding before it has completed,
+            # so up to max_outstanding fast and slow accesses overlap
+            if len(self.inflight) >= max(self.config["max_outstanding"], 1):
+                self.issue_cycle = max(self.issue_cycle, self.inflight.popleft())
+            event.current_cycle = max(event.current_cycle, self.issue_cycle)
+            self.flatmem.avail_cycle = event.current_cycle  # FlatMemory follows this request from now on
+            self.flatmem.retire(event.current_cycle)  # later requests never arrive earlier
+        else:
+            event.current_cycle = max(event.current_cycle, self.avail_cycle)
+
     def access(self, event):
-        set_id = extract_bit(event.p_addr, addr_set_low, addr_set_bit)
-        self.max_set_id = max(self.max_set_id, set_id)
-        if not set_id in self.metasets:
-            repl_policy = self.config["repl_policy"]
-            if self.config["repl_policy"] == ReplPolicy.Sample:
-                # if in Sample mode, set different policies for different sets. Output their hitrate respectively.
-                if set_id % 3 == 0:
-                    repl_policy = ReplPolicy.LRU
-                elif set_id % 3 == 1:
-                    repl_policy = ReplPolicy.LFU
-                elif set_id % 3 == 2:
-                    repl_policy = ReplPolicy.LRFU
-            self.metasets[set_id] = MetaCache(set_id, self.flatmem, repl_policy)
-        self.metasets[set_id].track_hotness(event)
-        self.metasets[set_id].access_trans_cache(event.p_addr)
+        self.issue_demand(event)
+        set_id = self.geometry.set_id(event.p_addr)
+        metaset = self.get_metaset(set_id)
+        metaset.track_hotness(event)
+        metaset.access_trans_cache(event.p_addr)
+        # the data access starts after the trans_table lookup
+        event.current_cycle = max(event.current_cycle, self.flatmem.avail_cycle)
         # print("cnt: %d granted access %x" % (self.access_cnt, event.p_addr))
 
         in_fast = self.flatmem.request(event)
+        if self.config["timing_model"] == TimingModel.Banked:
+            self.inflight.append(event.current_cycle)
 
         self.sync_cycle()
         # print("fast cycle:%d slow cycle:%d flat cycle:%d" % (self.flatmem.fastmem.avail_cycle, self.flatmem.slowmem.avail_cycle, self.avail_cycle))
@@ -616,39 +902,37 @@ class FlatController(TimingObj):
         if self.access_cnt % EPOCH_INTERVAL == 0:
             if self.access_cnt > 0:
                 if self.config["repl_policy"] != ReplPolicy.Sample:
-                    epoch_hitrate = 1.0 * sum(self.epoch_fasthit) / \
-                        (sum(self.epoch_slowhit) + sum(self.epoch_fasthit))
+                    epoch_hitrate = 1.0 * self.epoch_hit_sum(self.epoch_fasthit) / \
+                        (self.epoch_hit_sum(self.epoch_slowhit) + self.epoch_hit_sum(self.epoch_fasthit))
                     epoch_trans_hitrate = 1.0 * self.flatmem.epoch_trans_hit / self.flatmem.epoch_trans_access
                     # print("access count:%d\tfast access:%d\tslow access:%d\thitrate:%.2f" % (
-                    #     self.access_cnt, sum(self.epoch_fasthit), sum(self.epoch_slowhit), epoch_hitrate))
+                    #     self.access_cnt, self.epoch_hit_sum(self.epoch_fasthit), self.epoch_hit_sum(self.epoch_slowhit), epoch_hitrate))
                     # print("%d\t%d" % (self.flatmem.epoch_trans_hit, self.flatmem.epoch_trans_access))
                 else:
                     # display three replacement policies respectively
-                    fasthit_n = sum(self.epoch_fasthit[0::3])
-                    slowhit_n = sum(self.epoch_slowhit[0::3])
+                    fasthit_n = self.epoch_hit_sum(self.epoch_fasthit, 0)
+                    slowhit_n = self.epoch_hit_sum(self.epoch_slowhit, 0)
                     if fasthit_n + slowhit_n > 0:
                         print("[LRU]access count:%d\tfast access:%d\tslow access:%d\thitrate:%.2f" % (
-                            self.access_cnt, sum(self.epoch_fasthit[0::3]), sum(self.epoch_slowhit[0::3]), 1.0 * fasthit_n / (fasthit_n + slowhit_n)))
-                    fasthit_n = sum(self.epoch_fasthit[1::3])
-                    slowhit_n = sum(self.epoch_slowhit[1::3])
+                            self.access_cnt, fasthit_n, slowhit_n, 1.0 * fasthit_n / (fasthit_n + slowhit_n)))
+                    fasthit_n = self.epoch_hit_sum(self.epoch_fasthit, 1)
+                    slowhit_n = self.epoch_hit_sum(self.epoch_slowhit, 1)
                     if fasthit_n + slowhit_n > 0:
                         print("[LFU]access count:%d\tfast access:%d\tslow access:%d\thitrate:%.2f" % (
-                            self.access_cnt, sum(self.epoch_fasthit[1::3]), sum(self.epoch_slowhit[1::3]), 1.0 * fasthit_n / (fasthit_n + slowhit_n)))
-                    fasthit_n = sum(self.epoch_fasthit[2::3])
-                    slowhit_n = sum(self.epoch_slowhit[2::3])
+                            self.access_cnt, fasthit_n, slowhit_n, 1.0 * fasthit_n / (fasthit_n + slowhit_n)))
+                    fasthit_n = self.epoch_hit_sum(self.epoch_fasthit, 2)
+                    slowhit_n = self.epoch_hit_sum(self.epoch_slowhit, 2)
                     if fasthit_n + slowhit_n > 0:
                         print("[LRFU]access count:%d\tfast access:%d\tslow access:%d\thitrate:%.2f" % (
-                            self.access_cnt, sum(self.epoch_fasthit[2::3]), sum(self.epoch_slowhit[2::3]), 1.0 * fasthit_n / (fasthit_n + slowhit_n)))
-            self.epoch_fasthit = [0] * (self.max_set_id + 1)
-            self.epoch_slowhit = [0] * (self.max_set_id + 1)
+                            self.access_cnt, fasthit_n, slowhit_n, 1.0 * fasthit_n / (fasthit_n + slowhit_n)))
+            self.epoch_fasthit = {}
+            self.epoch_slowhit = {}
             self.flatmem.epoch_trans_hit = 0
             self.flatmem.epoch_trans_access = 0
         if in_fast:
-            if set_id < len(self.epoch_fasthit):
-                self.epoch_fasthit[set_id] += 1 # only record limited set hit info
+            self.epoch_fasthit[set_id] = self.epoch_fasthit.get(set_id, 0) + 1
         else:
-            if set_id < len(self.epoch_slowhit):
-                self.epoch_slowhit[set_id] += 1
+            self.epoch_slowhit[set_id] = self.epoch_slowhit.get(set_id, 0) + 1
         self.access_cnt += 1
 
     def showstats(self):
@@ -660,11 +944,20 @@ class FlatController(TimingObj):
             print("\tfastswap count %d" % (self.fast_swap_swap_cnt))
         elif self.config["swap_policy"] == SwapPolicy.SlowSwap:
             print("\tslowswap count %d" % (self.slow_swap_swap_cnt))
+        if self.config["max_metasets"] > 0:
+            print("\tmetaset resident:%d cold:%d evict:%d rebuild:%d drop:%d" % (len(self.metasets), len(self.cold_metasets),
+                                                                                  self.metaset_evict_cnt, self.metaset_rebuild_cnt, self.metaset_drop_cnt))
         if self.config["bypass_policy"] == BypassPolicy.Probability:
             print("\tbypass probability: %.2f" %
                   (self.config["bypass_probability"]))
         print("\tfast cycle:%d slow cycle:%d flat cycle:%d" % (
             self.flatmem.fastmem.used_cycle, self.flatmem.slowmem.used_cycle, self.avail_cycle))
+        if self.config["timing_model"] == TimingModel.Banked:
+            drain_cycle = self.flatmem.drain_cycle()
+            print("\tdrain cycle:%d fast util:%.2f slow util:%.2f" % (drain_cycle,
+                  self.flatmem.fastmem.utilization(drain_cycle), self.flatmem.slowmem.utilization(drain_cycle)))
+            print("\tfast avg queue cycle:%.2f slow avg queue cycle:%.2f" % (
+                self.flatmem.fastmem.avg_queue_cycle(), self.flatmem.slowmem.avg_queue_cycle()))
         print("\tcached fast trans:%d uncached fast trans:%d rate:%.2f" % (self.flatmem.cached_fast_trans_num, self.flatmem.uncached_fast_trans_num,
                                                                          (self.flatmem.cached_fast_trans_num / (self.flatmem.cached_fast_trans_num + self.flatmem.uncached_fast_trans_num))))
         print("\tfast access:%d slow access:%d hitrate:%.2f" % (self.flatmem.fastmem.access_cnt, self.flatmem.slowmem.access_cnt,